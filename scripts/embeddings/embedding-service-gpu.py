@@ -4,13 +4,17 @@ GPU-accelerated embedding service with VRAM management
 Supports dynamic model loading/unloading and CPU fallback
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from sentence_transformers import SentenceTransformer
 import torch
 import numpy as np
+import base64
+import orjson
 import time
 import os
+import queue
 import subprocess
+import threading
 
 app = Flask(__name__)
 
@@ -18,30 +22,55 @@ app = Flask(__name__)
 model = None
 model_name = os.environ.get('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
+# sentence-transformers sorts inputs by length before splitting them into batches of this size
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '32'))
+# Opt-in: graph-compile the transformer forward (slow first call, faster steady state)
+torch_compile = os.environ.get('TORCH_COMPILE', '0') == '1'
+
+# nvidia-smi forks cost tens of ms each; reuse results for a short window
+SMI_CACHE_TTL = float(os.environ.get('SMI_CACHE_TTL', '1.0'))
+_smi_cache = {}
+
+def _nvidia_smi_query(field, ttl=SMI_CACHE_TTL):
+    """Query a single GPU field via nvidia-smi, cached per argv for ttl seconds"""
+    argv = ('nvidia-smi', f'--query-gpu={field}', '--format=csv,noheader,nounits')
+    now = time.monotonic()
+    cached = _smi_cache.get(argv)
+    if cached is not None and now - cached[0] < ttl:
+        return cached[1]
+    result = subprocess.run(argv, capture_output=True, text=True)
+    value = int(result.stdout.strip())
+    _smi_cache[argv] = (now, value)
+    return value
+
+# NVML reads the same counters in-process; fall back to nvidia-smi if it is unavailable
+try:
+    import pynvml
+    pynvml.nvmlInit()
+    _nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+except Exception:
+    _nvml_handle = None
+
+def _gpu_memory_mb(field, ttl=SMI_CACHE_TTL):
+    """Read memory.free or memory.used in MB"""
+    if _nvml_handle is not None:
+        info = pynvml.nvmlDeviceGetMemoryInfo(_nvml_handle)
+        return (info.free if field == 'memory.free' else info.used) // (1024 * 1024)
+    return _nvidia_smi_query(field, ttl=ttl)
 
 def check_vram_available(required_mb):
     """Check if sufficient VRAM is available"""
     try:
-        result = subprocess.run(
-            ['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits'],
-            capture_output=True,
-            text=True
-        )
-        free_mb = int(result.stdout.strip())
+        free_mb = _gpu_memory_mb('memory.free', ttl=0)
         return free_mb >= required_mb
     except Exception as e:
         print(f"Error checking VRAM: {e}")
         return False
 
-def get_vram_usage():
+def get_vram_usage(ttl=SMI_CACHE_TTL):
     """Get current VRAM usage in MB"""
     try:
-        result = subprocess.run(
-            ['nvidia-smi', '--query-gpu=memory.used', '--format=csv,noheader,nounits'],
-            capture_output=True,
-            text=True
-        )
-        return int(result.stdout.strip())
+        return _gpu_memory_mb('memory.used', ttl=ttl)
     except Exception as e:
         print(f"Error getting VRAM usage: {e}")
         return 0
@@ -70,10 +99,12 @@ def load_model(force_device=None):
         
         model = SentenceTransformer(model_name)
         model.to(target_device)
+        if torch_compile and target_device == 'cuda':
+            model[0].auto_model = torch.compile(model[0].auto_model, dynamic=True)
         print(f"Model loaded successfully on {target_device}. Dimensions: {model.get_sentence_embedding_dimension()}")
         
         if target_device == 'cuda':
-            vram_usage = get_vram_usage()
+            vram_usage = get_vram_usage(ttl=0)
             print(f"Current VRAM usage: {vram_usage}MB")
     
     return model, target_device
@@ -82,13 +113,94 @@ def unload_model():
     """Unload the model to free VRAM"""
     global model
     if model is not None:
-        vram_before = get_vram_usage() if device == 'cuda' else 0
+        vram_before = get_vram_usage(ttl=0) if device == 'cuda' else 0
         del model
         model = None
         torch.cuda.empty_cache()
-        vram_after = get_vram_usage() if device == 'cuda' else 0
+        vram_after = get_vram_usage(ttl=0) if device == 'cuda' else 0
         print(f"Model unloaded. VRAM freed: {vram_before - vram_after}MB")
 
+# Opt-in: coalesce concurrent requests arriving within this window into one encode call
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', '0'))
+_batch_queue = queue.Queue()
+
+def _batch_worker():
+    """Drain queued encode requests and run them as combined batches"""
+    while True:
+        items = [_batch_queue.get()]
+        deadline = time.monotonic() + BATCH_WINDOW_MS / 1000
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(_batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        groups = {}
+        for item in items:
+            groups.setdefault((id(item['model']), item['device']), []).append(item)
+
+        for group in groups.values():
+            texts = [text for item in group for text in item['texts']]
+            try:
+                with torch.inference_mode():
+                    embeddings = group[0]['model'].encode(
+                        texts,
+                        batch_size=BATCH_SIZE,
+                        convert_to_numpy=True,
+                        device=group[0]['device']
+                    )
+                offset = 0
+                for item in group:
+                    item['result'] = embeddings[offset:offset + len(item['texts'])]
+                    offset += len(item['texts'])
+            except Exception as e:
+                for item in group:
+                    item['error'] = e
+            for item in group:
+                item['done'].set()
+
+if BATCH_WINDOW_MS > 0:
+    threading.Thread(target=_batch_worker, daemon=True).start()
+
+def encode_texts(model, texts, target_device):
+    """Encode texts, sharing a batch with concurrent requests when enabled"""
+    unique = list(dict.fromkeys(texts))
+    if len(unique) < len(texts):
+        position = {text: i for i, text in enumerate(unique)}
+        embeddings = encode_texts(model, unique, target_device)
+        return embeddings[[position[text] for text in texts]]
+
+    if BATCH_WINDOW_MS <= 0:
+        with torch.inference_mode():
+            return model.encode(
+                texts, batch_size=BATCH_SIZE, convert_to_numpy=True, device=target_device
+            )
+
+    item = {'model': model, 'device': target_device, 'texts': texts, 'done': threading.Event()}
+    _batch_queue.put(item)
+    item['done'].wait()
+    if 'error' in item:
+        raise item['error']
+    return item['result']
+
+VECTOR_ENCODINGS = ('float', 'base64_float16')
+
+def pack_vectors(embeddings, encoding):
+    """Return embeddings unchanged, or as base64 of little-endian float16 values"""
+    if encoding == 'base64_float16':
+        return base64.b64encode(embeddings.astype('<f2').tobytes()).decode('ascii')
+    return embeddings
+
+def embedding_response(payload):
+    """Serialize a payload holding numpy arrays without going through lists"""
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        mimetype='application/json'
+    )
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -121,10 +233,16 @@ def embed():
         data = request.json
         texts = data.get('texts', [])
         use_gpu = data.get('use_gpu', True)
+        encoding = data.get('encoding', 'float')
         
         if not texts:
             return jsonify({'error': 'No texts provided'}), 400
         
+        if isinstance(texts, str):
+            texts = [texts]
+        if encoding not in VECTOR_ENCODINGS:
+            return jsonify({'error': f'Unsupported encoding: {encoding}'}), 400
+        
         # Determine device
         target_device = 'cuda' if (use_gpu and torch.cuda.is_available()) else 'cpu'
         
@@ -133,18 +251,16 @@ def embed():
         
         # Generate embeddings
         start_time = time.time()
-        embeddings = model.encode(texts, convert_to_numpy=True, device=actual_device)
+        embeddings = encode_texts(model, texts, actual_device)
         elapsed_time = time.time() - start_time
         
         # Get VRAM usage if GPU
         vram_usage = get_vram_usage() if actual_device == 'cuda' else 0
         
-        # Convert to list for JSON serialization
-        embeddings_list = embeddings.tolist()
-        
-        return jsonify({
-            'embeddings': embeddings_list,
-            'dimensions': len(embeddings_list[0]) if embeddings_list else 0,
+        return embedding_response({
+            'embeddings': pack_vectors(embeddings, encoding),
+            'encoding': encoding,
+            'dimensions': embeddings.shape[1] if len(embeddings) else 0,
             'count': len(texts),
             'time_seconds': elapsed_time,
             'model': model_name,
@@ -162,9 +278,12 @@ def embed_single():
         data = request.json
         text = data.get('text', '')
         use_gpu = data.get('use_gpu', True)
+        encoding = data.get('encoding', 'float')
         
         if not text:
             return jsonify({'error': 'No text provided'}), 400
+        if encoding not in VECTOR_ENCODINGS:
+            return jsonify({'error': f'Unsupported encoding: {encoding}'}), 400
         
         # Determine device
         target_device = 'cuda' if (use_gpu and torch.cuda.is_available()) else 'cpu'
@@ -174,18 +293,16 @@ def embed_single():
         
         # Generate embedding
         start_time = time.time()
-        embedding = model.encode([text], convert_to_numpy=True, device=actual_device)[0]
+        embedding = encode_texts(model, [text], actual_device)[0]
         elapsed_time = time.time() - start_time
         
         # Get VRAM usage if GPU
         vram_usage = get_vram_usage() if actual_device == 'cuda' else 0
         
-        # Convert to list for JSON serialization
-        embedding_list = embedding.tolist()
-        
-        return jsonify({
-            'embedding': embedding_list,
-            'dimensions': len(embedding_list),
+        return embedding_response({
+            'embedding': pack_vectors(embedding, encoding),
+            'encoding': encoding,
+            'dimensions': len(embedding),
             'time_seconds': elapsed_time,
             'model': model_name,
             'device': actual_device,
@@ -211,7 +328,11 @@ if __name__ == '__main__':
     print(f"CUDA available: {torch.cuda.is_available()}")
     print(f"Default device: {device}")
     
-    # Don't pre-load model - load on demand to save VRAM
-    print("Model will be loaded on demand")
+    # Load on demand by default to save VRAM; PRELOAD_MODEL=1 trades that for first-request latency
+    if os.environ.get('PRELOAD_MODEL', '0') == '1':
+        warm_model, warm_device = load_model()
+        encode_texts(warm_model, ['warmup'], warm_device)
+    else:
+        print("Model will be loaded on demand")
     
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file